@@ -3,8 +3,8 @@ store all the agents here
 """
 from replay_buffer import ReplayBuffer, ReplayBufferNumpy
 import numpy as np
+import os
 import time
-import pickle
 from collections import deque, OrderedDict
 import json
 
@@ -13,6 +13,40 @@ import torch
 import torch.nn as nn
 from torch.nn import functional as F
 
+# the convolutions and linear layers are tiny, let cudnn pick the fastest
+# algorithms and allow TF32 math on gpus that support it
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.backends.cudnn.benchmark = True
+
+
+def _use_torch_compile(device):
+    """Whether to run the DQN model and training step through torch.compile.
+    Needs torch >= 2.2 and a platform dynamo supports, and by default only
+    runs on cuda (reduce-overhead gains little on cpu and inductor needs a
+    C++ toolchain there). The environment variable SNAKE_TORCH_COMPILE
+    overrides this, 0 always runs eagerly, 1 compiles on any device
+
+    Parameters
+    ----------
+    device : torch.device
+        The device the models are placed on
+
+    Returns
+    -------
+    use_compile : bool
+        True if the models should be compiled
+    """
+    env = os.environ.get('SNAKE_TORCH_COMPILE', '').strip()
+    if (env == '0' or not hasattr(nn.Module, 'compile')):
+        return False
+    try:
+        import torch._dynamo
+        if (not torch._dynamo.is_dynamo_supported()):
+            return False
+    except Exception:
+        return False
+    return env == '1' or device.type == 'cuda'
 
 
 # Changed from Tensorflow to Pytorch
@@ -36,11 +70,8 @@ def huber_loss(y_true, y_pred, delta=1):
     loss : Tensor
         loss values for all points
     """
-    error = (y_true - y_pred)
-    quad_error = 0.5 * torch.square(error)
-    lin_error = delta * (torch.abs(error) - 0.5 * delta)
-    # quadratic error, linear error
-    return torch.where(torch.abs(error) < delta, quad_error, lin_error)
+    # fused kernel, no intermediate quadratic/linear error tensors
+    return F.huber_loss(y_pred, y_true, reduction='none', delta=delta)
 
 # Changed from Tensorflow to Pytorch
 def mean_huber_loss(y_true, y_pred, delta=1):
@@ -60,7 +91,7 @@ def mean_huber_loss(y_true, y_pred, delta=1):
     loss : Tensor
         average loss across points
     """
-    return torch.mean(huber_loss(y_true, y_pred, delta))
+    return F.huber_loss(y_pred, y_true, reduction='mean', delta=delta)
 
 
 # Deep Q CNN Network for target
@@ -91,9 +122,9 @@ class DeepQCNN(nn.Module):
 # CNN for evaluation/critic network
 class AAC_CNN(nn.Module):
     # output alog -logits (probability distribution over actions) and state values.
-    def __init__(self, p):
+    # both heads share the same trunk, so one forward gives both outputs
+    def __init__(self):
         super(AAC_CNN, self).__init__()
-        self.param = p
         self.conv1 = nn.Conv2d(2, 16, (3, 3))
         self.conv2 = nn.Conv2d(16, 32, (3, 3))
         self.flat = nn.Flatten()
@@ -106,12 +137,14 @@ class AAC_CNN(nn.Module):
         x = F.relu(self.conv2(x))
         x = self.flat(x)
         x = F.relu(self.fc1(x))
-        if self.param == "logits":
-            return self.action_logits(x)
-        elif self.param == "values":
-            return self.state_value(x)
-        elif self.param == "full":
-            return self.action_logits(x), self.state_value(x)
+        return self.action_logits(x), self.state_value(x)
+
+    # call through self so that a compiled module is used
+    def logits(self, x):
+        return self(x)[0]
+
+    def values(self, x):
+        return self(x)[1]
 
 
 class Agent():
@@ -147,7 +180,11 @@ class Agent():
         Useful when converting between row, col and int representation
     _version : str
         model version string
+    _pin_buffer : bool
+        Whether the replay buffer is kept in pinned memory, only for
+        agents that sample it as torch tensors
     """
+    _pin_buffer = False
 
     def __init__(self, board_size=10, frames=2, buffer_size=10000,
                  gamma=0.99, n_actions=3, use_target_net=True,
@@ -207,7 +244,8 @@ class Agent():
         if (buffer_size is not None):
             self._buffer_size = buffer_size
         self._buffer = ReplayBufferNumpy(self._buffer_size, self._board_size,
-                                         self._n_frames, self._n_actions)
+                                         self._n_frames, self._n_actions,
+                                         pin_memory=self._pin_buffer)
 
     def get_buffer_size(self):
         """Get the current buffer size
@@ -254,8 +292,7 @@ class Agent():
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        with open("{}/buffer_{:04d}".format(file_path, iteration), 'wb') as f:
-            pickle.dump(self._buffer, f)
+        self._buffer.save("{}/buffer_{:04d}.npz".format(file_path, iteration))
 
     def load_buffer(self, file_path='', iteration=None):
         """Load the buffer from disk
@@ -272,13 +309,22 @@ class Agent():
         ------
         FileNotFoundError
             If the requested file could not be located on the disk
+        ValueError
+            If the buffer on disk does not match the agent's board size,
+            frames or actions
         """
         if (iteration is not None):
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        with open("{}/buffer_{:04d}".format(file_path, iteration), 'rb') as f:
-            self._buffer = pickle.load(f)
+        file_name = "{}/buffer_{:04d}".format(file_path, iteration)
+        if (os.path.exists(file_name + '.npz')):
+            self._buffer.load(file_name + '.npz')
+        elif (os.path.exists(file_name)):
+            # buffers saved by older versions were pickled
+            self._buffer.load_pickle(file_name)
+        else:
+            raise FileNotFoundError("No buffer found at {}.npz".format(file_name))
 
     def _point_to_row_col(self, point):
         """Covert a point value to row, col value
@@ -328,6 +374,8 @@ class DeepQLearningAgent(Agent):
     _target_net : Torch Graph
         Stores the target network graph of the DQN model
     """
+    # train_agent samples the buffer with sample_torch
+    _pin_buffer = True
 
     def __init__(self, board_size=10, frames=4, buffer_size=10000,
                  gamma=0.99, n_actions=3, use_target_net=True,
@@ -339,18 +387,81 @@ class DeepQLearningAgent(Agent):
         Agent.__init__(self, board_size=board_size, frames=frames, buffer_size=buffer_size,
                        gamma=gamma, n_actions=n_actions, use_target_net=use_target_net,
                        version=version)
+        # board normalization, folded into the first convolution weights
+        self._input_scale = 0.25
+        # models are kept on a fixed device so compiled graphs stay valid
+        self._device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        # contiguous float32 buffer reused by _prepare_input, grown when needed,
+        # pinned on gpu runs so copies to the device can be asynchronous
+        self._prep_buf = torch.empty((1, self._n_frames, self._board_size, self._board_size),
+                                     pin_memory=self._device.type == 'cuda')
+        # marks the end of the last copy out of self._prep_buf
+        self._prep_event = torch.cuda.Event() if self._device.type == 'cuda' else None
+        # bfloat16 mixed precision for training, needs no grad scaler, only on
+        # gpus with native bf16 (Ampere and newer), older ones emulate it
+        self._use_bf16 = self._device.type == 'cuda' and \
+                         torch.cuda.get_device_capability(self._device)[0] >= 8
+        self._use_compile = _use_torch_compile(self._device)
+        self._train_step_fn = None
+        self._compute_target_fn = None
+        self._train_inputs = None
         self.reset_models()
 
     def reset_models(self):
         """ Reset all the models by creating new graphs"""
-        self._model = self._agent_model()
+        self._model = self._agent_model().to(self._device)
         if (self._use_target_net):
-            self._target_net = self._agent_model()
+            self._target_net = self._agent_model().to(self._device)
             self.update_target_net()
-        #self.optimizer = torch.optim.RMSprop(self._model.parameters(), lr=0.0005)
+        # single optimizer for the training model, keeps RMSprop state across steps
+        # RMSprop steps do not depend on the gradient scale, so conv1.weight
+        # which holds the folded normalization gets its learning rate scaled
+        # (and eps, as its gradients are 1/scale larger), updates then match
+        # the unfolded model
+        lr, eps = 0.0005, 1e-8
+        conv1_weight = self._model.conv1.weight
+        self.optimizer = torch.optim.RMSprop(
+            [{'params': [p for p in self._model.parameters() if p is not conv1_weight]},
+             {'params': [conv1_weight], 'lr': lr * self._input_scale,
+              'eps': eps / self._input_scale}], lr=lr, eps=eps)
+        # compiled functions are tied to the old models, rebuild lazily
+        self._train_step_fn = None
+        self._compute_target_fn = None
+        self._fold_normalization()
+
+    def _fold_normalization(self):
+        """Fold the board normalization into the first convolution,
+        (x * scale) * W + b == x * (W * scale) + b, so the inputs are
+        only cast to float32 and not scaled on every forward pass
+        """
+        with torch.no_grad():
+            self._model.conv1.weight.mul_(self._input_scale)
+            if (self._use_target_net):
+                self._target_net.conv1.weight.mul_(self._input_scale)
+
+    def _unfolded_state_dict(self, model):
+        """State dict of model with the normalization taken out of the
+        first convolution, files on disk keep the normalized input convention
+
+        Parameters
+        ----------
+        model : Torch Graph
+            The model to get the weights of
+
+        Returns
+        -------
+        state_dict : OrderedDict
+            Weights of the model as expected by load_model
+        """
+        state_dict = model.state_dict()
+        state_dict['conv1.weight'] = state_dict['conv1.weight'] / self._input_scale
+        return state_dict
 
     def _prepare_input(self, board):
-        """Reshape input and normalize
+        """Reshape input to channels first and cast to float32, the board
+        is not normalized here, the scaling is folded into the first
+        convolution of self._model and self._target_net (see
+        _fold_normalization), other models would get inputs 1/scale too large
 
         Parameters
         ----------
@@ -360,16 +471,86 @@ class DeepQLearningAgent(Agent):
         Returns
         -------
         board : Numpy array
-            Processed and normalized board
+            Raw board as float32 for the folded models, this is a view on a
+            buffer reused by the next call, copy it if it needs to be kept
         """
         if (board.ndim == 3):
             board = board.reshape((1,) + self._input_shape)
 
-        # rolling the axis to change shape (64, 2, 10, 10) to (64, 10, 10, 2)
-        board = np.rollaxis(board, 3, 1)
+        if (board.shape[0] > self._prep_buf.shape[0]):
+            self._prep_buf = torch.empty((board.shape[0],) + tuple(self._prep_buf.shape[1:]),
+                                         pin_memory=self._device.type == 'cuda')
+        # an asynchronous copy to the device may still be reading the buffer
+        if (self._prep_event is not None):
+            self._prep_event.synchronize()
+
+        # transposing shape (64, 10, 10, 2) to (64, 2, 10, 10) is fused
+        # with the float32 cast, written straight into the contiguous buffer
+        return self._cast_board(board.transpose(0, 3, 1, 2),
+                                     out=self._prep_buf[:board.shape[0]].numpy())
+
+    def _board_to_device(self, board, copy=False):
+        """Prepare the board and send it to the model device, the copy
+        from the pinned buffer does not block on gpu runs
+
+        Parameters
+        ----------
+        board : Numpy array
+            The board state to process
+        copy : bool, optional
+            Always copy, on cpu the result is otherwise a view on the
+            buffer reused by the next call
+
+        Returns
+        -------
+        board : Tensor
+            Processed board on the model device
+        """
+        n = self._prepare_input(board).shape[0]
+        board = self._prep_buf[:n].to(self._device, non_blocking=True, copy=copy)
+        if (self._prep_event is not None):
+            self._prep_event.record()
+        return board
 
-        board = self._normalize_board(board.copy())
-        return board.copy()
+    def _prepare_input_tensor(self, board, out):
+        """Torch counterpart of _prepare_input for boards sampled
+        from the buffer, writes the raw board as float32 into out,
+        only for the folded models (see _prepare_input)
+
+        Parameters
+        ----------
+        board : Tensor
+            The board states to process, batch * board size * board size * frames
+        out : Tensor
+            Float tensor on the model device, batch * frames * board size * board size
+
+        Returns
+        -------
+        out : Tensor
+            Raw board as float32 for the folded models
+        """
+        # send the raw uint8 board first, a pinned contiguous source keeps the
+        # copy asynchronous, permute and float cast then run on the device
+        board = board.to(self._device, non_blocking=True)
+        # scaling is folded into the model, see _fold_normalization
+        return out.copy_(board.permute(0, 3, 1, 2))
+
+    def _model_outputs(self, model, board):
+        """Forward pass giving the outputs used for acting, Q values here
+
+        Parameters
+        ----------
+        model : Torch Graph
+            The graph to use for prediction
+        board : Tensor
+            Prepared board state on the model device
+
+        Returns
+        -------
+        model_outputs : Tensor
+            Model outputs, board.shape[0] * num actions
+        """
+        return model(board)
 
     def _get_model_outputs(self, board, model=None):
         """Get action values from the DQN model
@@ -387,28 +568,36 @@ class DeepQLearningAgent(Agent):
             Predicted model outputs on board,
             of shape board.shape[0] * num actions
         """
-        # to correct dimensions and normalize
-        board = torch.Tensor(self._prepare_input(board))
+        # to correct dimensions and dtype, normalization is folded in the model
+        board = self._board_to_device(board)
         if model is None:
             model = self._model
-        return model(board).detach().numpy()
+        with torch.inference_mode():
+            return self._model_outputs(model, board).cpu().numpy()
 
-    def _normalize_board(self, board):
-        """Normalize the board before input to the network
+    def _cast_board(self, board, out=None):
+        """Cast the board to float32 before input to the network, it does
+        not scale, normalization is folded into the first convolution
 
         Parameters
         ----------
         board : Numpy array
-            The board state to normalize
+            The board state to cast
+        out : Numpy array, optional
+            float32 array to write the result into, allocated if None
 
         Returns
         -------
         board : Numpy array
-            The copy of board state after normalization
+            The board state as float32, the scaling by self._input_scale
+            is folded into the model weights
         """
         # return board.copy()
         # return((board/128.0 - 1).copy())
-        return board.astype(np.float32) / 4.0
+        if (out is None):
+            return board.astype(np.float32)
+        np.copyto(out, board)
+        return out
 
     def move(self, board, legal_moves, value=None):
         """Get the action with maximum Q value
@@ -417,6 +606,8 @@ class DeepQLearningAgent(Agent):
         ----------
         board : Numpy array
             The board state on which to calculate best action
+        legal_moves : Numpy array
+            Binary indicators for the actions allowed on board
         value : None, optional
             Kept for consistency with other agent classes
 
@@ -425,9 +616,13 @@ class DeepQLearningAgent(Agent):
         output : Numpy array
             Selected action using the argmax function
         """
-        # use the agent model to make the predictions
-        model_outputs = self._get_model_outputs(board, self._model)
-        return np.argmax(np.where(legal_moves == 1, model_outputs, -np.inf), axis=1)
+        # use the agent model to make the predictions, keeping outputs in torch
+        board = self._board_to_device(board)
+        legal_moves = torch.as_tensor(legal_moves, device=self._device)
+        with torch.inference_mode():
+            model_outputs = self._model_outputs(self._model, board)
+            return model_outputs.masked_fill_(legal_moves != 1, -math.inf)\
+                                .argmax(dim=1).cpu().numpy()
 
     def _agent_model(self):
         """Returns the model which evaluates Q values for a given state input
@@ -439,7 +634,11 @@ class DeepQLearningAgent(Agent):
         """
         # using the layers from json file v17.1
         model = DeepQCNN()
-        self.optimizer = torch.optim.RMSprop(model.parameters(), lr=0.0005)
+        if (self._use_compile):
+            # compile in place so that the state dict keys stay the same as
+            # the eager model, dynamic=None stops specializing the batch size
+            # once a second size is seen (games played vs training batch)
+            model.compile(mode="reduce-overhead", dynamic=None)
         return model
 
     def set_weights_trainable(self):
@@ -471,14 +670,11 @@ class DeepQLearningAgent(Agent):
         model_outputs : Numpy array
             Action probabilities, shape is board.shape[0] * n_actions
         """
-        model_outputs = self._get_model_outputs(board, self._model)
-        # subtracting max and taking softmax does not change output
-        # do this for numerical stability
-        model_outputs = np.clip(model_outputs, -10, 10)
-        model_outputs = model_outputs - model_outputs.max(axis=1).reshape((-1, 1))
-        model_outputs = np.exp(model_outputs)
-        model_outputs = model_outputs / model_outputs.sum(axis=1).reshape((-1, 1))
-        return model_outputs
+        board = self._board_to_device(board)
+        with torch.inference_mode():
+            model_outputs = self._model_outputs(self._model, board).clamp_(-10, 10)
+            # torch softmax is numerically stable and a single kernel
+            return torch.softmax(model_outputs, dim=1).cpu().numpy()
 
     def save_model(self, file_path='', iteration=None):
         """Save the current models to disk using Torch's
@@ -499,10 +695,10 @@ class DeepQLearningAgent(Agent):
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        torch.save(self._model.state_dict(), "{}/model_{:04d}.pt".format(file_path, iteration))
+        torch.save(self._unfolded_state_dict(self._model), "{}/model_{:04d}.pt".format(file_path, iteration))
         # self._model.save_weights("{}/model_{:04d}.h5".format(file_path, iteration))
         if (self._use_target_net):
-            torch.save(self._target_net.state_dict(), "{}/model_{:04d}_target.pt".format(file_path, iteration))
+            torch.save(self._unfolded_state_dict(self._target_net), "{}/model_{:04d}_target.pt".format(file_path, iteration))
             #self._target_net.save_weights("{}/model_{:04d}_target.h5".format(file_path, iteration))
 
     #Similarily using torch to load model
@@ -528,9 +724,10 @@ class DeepQLearningAgent(Agent):
             assert isinstance(iteration, int), "iteration should be an integer"
         else:
             iteration = 0
-        self._model.load_state_dict(torch.load("{}/model_{:04d}.pt".format(file_path, iteration)))
+        self._model.load_state_dict(torch.load("{}/model_{:04d}.pt".format(file_path, iteration), map_location=self._device))
         if (self._use_target_net):
-            self._target_net.load_state_dict(torch.load("{}/model_{:04d}_target.pt".format(file_path, iteration)))
+            self._target_net.load_state_dict(torch.load("{}/model_{:04d}_target.pt".format(file_path, iteration), map_location=self._device))
+        self._fold_normalization()
 
     def print_models(self):
         """Print the current models using summary method"""
@@ -540,39 +737,150 @@ class DeepQLearningAgent(Agent):
             print('Target Network')
             print(self._target_net.summary())
 
+    def _get_train_inputs(self, batch_size):
+        """Returns the preallocated input tensors for the training step,
+        the tensors are only created again if the batch size changes so that
+        the compiled graphs always see the same shapes and addresses
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of samples in the current batch
+
+        Returns
+        -------
+        train_inputs : dict
+            Tensors for s, a, r, next_s, done and legal_moves on model device
+        """
+        if (self._train_inputs is None or
+                self._train_inputs['s'].shape[0] != batch_size):
+            board_shape = (batch_size, self._n_frames,
+                           self._board_size, self._board_size)
+            self._train_inputs = {
+                's': torch.zeros(board_shape, device=self._device),
+                'a': torch.zeros((batch_size, self._n_actions), device=self._device),
+                'r': torch.zeros((batch_size, 1), device=self._device),
+                'next_s': torch.zeros(board_shape, device=self._device),
+                'done': torch.zeros((batch_size, 1), device=self._device),
+                # same dtype as the buffer so the copy needs no cast on the host
+                'legal_moves': torch.zeros((batch_size, self._n_actions),
+                                           dtype=torch.uint8, device=self._device)
+            }
+        return self._train_inputs
+
+    def _compute_target(self, next_s_t, r_t, done_t, legal_t):
+        """Calculate the expected future discounted reward for the batch
+
+        Parameters
+        ----------
+        next_s_t : Tensor
+            Prepared next states, batch size * frames * board size * board size
+        r_t : Tensor
+            Rewards, batch size * 1
+        done_t : Tensor
+            Binary indicators for game termination, batch size * 1
+        legal_t : Tensor
+            Binary indicators for legal moves in next state,
+            batch size * num actions
+
+        Returns
+        -------
+        discounted_reward : Tensor
+            Target value for the selected action, batch size * 1
+        """
+        current_model = self._target_net if self._use_target_net else self._model
+        next_model_outputs = current_model(next_s_t)
+        # mask in place, the outputs are not needed anywhere else
+        max_next_outputs, _ = next_model_outputs.masked_fill_(legal_t == 0, -math.inf)\
+                                                .max(dim=1, keepdim=True)
+        return r_t + self._gamma * max_next_outputs * (1 - done_t)
+
+    def _train_step(self, s_t, a_t, target_t):
+        """Forward pass and loss on the batch, only the column with action
+        has a different target value than the model prediction
+
+        Parameters
+        ----------
+        s_t : Tensor
+            Prepared states, batch size * frames * board size * board size
+        a_t : Tensor
+            One hot encoded actions, batch size * num actions
+        target_t : Tensor
+            Discounted reward for the selected action, batch size * 1
+
+        Returns
+        -------
+        loss : Tensor
+            Mean huber loss on the batch
+        """
+        model_outputs = self._model(s_t)
+        # we bother only with the difference in reward estimate at the selected action
+        target = (1 - a_t) * model_outputs.detach() + a_t * target_t
+        return mean_huber_loss(target, model_outputs)
+
     # Training the Deep Q Learning Agent
     def train_agent(self, batch_size=32, num_games=1, reward_clip=False):
+        """Train the model by sampling from buffer and return the error.
+        The forward pass and loss are run through torch.compile, when
+        _use_torch_compile allows it, so that the small elementwise operations
+        are fused and, on cuda, replayed as a cuda graph
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            The number of examples to sample from buffer
+        num_games : int, optional
+            Not used here, kept for consistency with other agents
+        reward_clip : bool, optional
+            Whether to clip the rewards using the sign of the reward
 
-        criterion = mean_huber_loss
-        optimizer = torch.optim.RMSprop(self._model.parameters(), lr=0.0005)
+        Returns
+        -------
+        loss : Numpy array
+            The current error (error metric is mean huber loss)
+        """
+        if (self._train_step_fn is None):
+            if (self._use_compile):
+                torch._dynamo.reset()
+                self._train_step_fn = torch.compile(self._train_step, fullgraph=True,
+                                                    mode="reduce-overhead")
+                self._compute_target_fn = torch.compile(self._compute_target, fullgraph=True,
+                                                        mode="reduce-overhead")
+            else:
+                self._train_step_fn = self._train_step
+                self._compute_target_fn = self._compute_target
 
         # Setting up transition samles for replay buffer
-        s, a, r, next_s, done, legal_moves = self._buffer.sample(batch_size)
+        s, a, r, next_s, done, legal_moves = self._buffer.sample_torch(batch_size)
+
+        # copy into the static input tensors, overlaps with compute when pinned
+        inputs = self._get_train_inputs(s.shape[0])
+        self._prepare_input_tensor(s, inputs['s'])
+        inputs['a'].copy_(a, non_blocking=True)
+        inputs['r'].copy_(r, non_blocking=True)
+        self._prepare_input_tensor(next_s, inputs['next_s'])
+        inputs['done'].copy_(done, non_blocking=True)
+        inputs['legal_moves'].copy_(legal_moves, non_blocking=True)
         if (reward_clip):
-            r = np.sign(r)
-        # calculate the discounted reward, and then train accordingly
-        current_model = self._target_net if self._use_target_net else self._model
+            inputs['r'].sign_()
 
-        next_model_outputs = self._get_model_outputs(next_s, current_model)
-        # our estimate of expected future discounted reward
-        discounted_reward = r + \
-                            (self._gamma * np.max(np.where(legal_moves == 1, next_model_outputs, -np.inf),
-                                                  axis=1).reshape(-1, 1)) * (1 - done)
-        # create the target variable, only the column with action has different value
-        target = self._get_model_outputs(s)
-        # we bother only with the difference in reward estimate at the selected action
-        target = (1 - a) * target + a * discounted_reward
+        with torch.autocast(device_type=self._device.type, dtype=torch.bfloat16,
+                            enabled=self._use_bf16):
+            # our estimate of expected future discounted reward
+            with torch.no_grad():
+                discounted_reward = self._compute_target_fn(inputs['next_s'], inputs['r'],
+                                                            inputs['done'], inputs['legal_moves'])
 
-        # Compute loss
-        loss = criterion(torch.Tensor(self._model(torch.Tensor(self._prepare_input(s)))), torch.Tensor(target))
-        
-        # Zero out the gradients
-        self.optimizer.zero_grad()
+            # Compute loss, huber loss is always computed in float32
+            loss = self._train_step_fn(inputs['s'], inputs['a'], discounted_reward)
+
+        # Zero out the gradients, dropping them is cheaper than filling with zeros
+        self.optimizer.zero_grad(set_to_none=True)
 
         # Optimizing steps (backward pass and gradient update)
         loss.backward()
         self.optimizer.step()
-        return loss.detach().numpy()
+        return loss.detach().cpu().numpy()
 
     # Target network updates here:
     def update_target_net(self):
@@ -582,10 +890,13 @@ class DeepQLearningAgent(Agent):
         This should not be updated very frequently
         """
         if (self._use_target_net):
-            m_dict = self._model.state_dict()
-            t_dict = self._target_net.state_dict()
-            for key in m_dict.keys():
-                t_dict[key] = m_dict[key]
+            # copy in place into the target storage, one multi tensor kernel
+            with torch.no_grad():
+                torch._foreach_copy_(list(self._target_net.parameters()),
+                                     list(self._model.parameters()))
+                target_buffers = list(self._target_net.buffers())
+                if (len(target_buffers) > 0):
+                    torch._foreach_copy_(target_buffers, list(self._model.buffers()))
 
     def compare_weights(self):
         """Simple utility function to heck if the model and target
@@ -613,11 +924,13 @@ class AdvantageActorCriticAgent(DeepQLearningAgent):
 
     Attributes
     ----------
-    _action_values_model : Torch Graph
-        Contains the network for the action values calculation model
-    _actor_update : function
-        Custom function to prepare the
+    _model : Torch Graph
+        Single network with shared trunk, returns action logits and state values
+    _target_net : Torch Graph
+        Copy of the network used for the next state values
     """
+    # the buffer is reset every episode and only sampled as numpy
+    _pin_buffer = False
 
     def __init__(self, board_size=10, frames=4, buffer_size=10000,
                  gamma=0.99, n_actions=3, use_target_net=True,
@@ -626,27 +939,21 @@ class AdvantageActorCriticAgent(DeepQLearningAgent):
                                     buffer_size=buffer_size, gamma=gamma,
                                     n_actions=n_actions, use_target_net=use_target_net,
                                     version=version)
-        # Changed to Pytorch
-        self._optimizer = torch.optim.RMSprop
-
 
 
     def _agent_model(self):
-        """Returns the models which evaluate prob logits and action values
-        for a given state input, Model is compiled in a different function
+        """Returns the model which evaluates prob logits and state values
+        for a given state input, both heads share the convolution trunk
         Overrides parent
 
         Returns
         -------
-        model_logits : Torch Graph
-            A2C model graph for action logits
-        model_full : Torch Graph
-            A2C model complete graph
+        model : Torch Graph
+            A2C model graph returning action logits and state values
         """
 
-        model_logits = AAC_CNN("logits")
-        model_values = AAC_CNN("values")
-        model_full = AAC_CNN("full")
+        # not compiled, the episode buffer trained on changes size every call
+        model = AAC_CNN()
         """input_board = Input((self._board_size, self._board_size, self._n_frames,))
         x = Conv2D(16, (3, 3), activation='relu', data_format='channels_last')(input_board)
         x = Conv2D(32, (3, 3), activation='relu', data_format='channels_last')(x)
@@ -660,78 +967,11 @@ class AdvantageActorCriticAgent(DeepQLearningAgent):
         model_values = Model(inputs=input_board, outputs=state_values)"""
         # updates are calculated in the train_agent function
 
-        return model_logits, model_full, model_values
-
-    def reset_models(self):
-        """ Reset all the models by creating new graphs"""
-        self._model, self._full_model, self._values_model = self._agent_model()
-        if (self._use_target_net):
-            _, _, self._target_net = self._agent_model()
-            self.update_target_net()
-
-    def save_model(self, file_path='', iteration=None):
-        """Save the current models to disk using Torch's
-        inbuilt save model function (saves in h5 format)
-        saving weights instead of model as cannot load compiled
-        model with any kind of custom object (loss or metric)
-
-        Parameters
-        ----------
-        file_path : str, optional
-            Path where to save the file
-        iteration : int, optional
-            Iteration number to tag the file name with, if None, iteration is 0
-        """
-        if (iteration is not None):
-            assert isinstance(iteration, int), "iteration should be an integer"
-        else:
-            iteration = 0
-
-        torch.save(self._model.state_dict(), "{}/model_{:04d}.pt".format(file_path, iteration))
-        torch.save(self._full_model.state_dict(), "{}/model_{:04d}_full.pt".format(file_path, iteration))
-        # self._model.save_weights("{}/model_{:04d}.h5".format(file_path, iteration))
-        # self._full_model.save_weights("{}/model_{:04d}_full.h5".format(file_path, iteration))
-        if (self._use_target_net):
-            torch.save(self._values_model.state_dict(), "{}/model_{:04d}_values.pt".format(file_path, iteration))
-            torch.save(self._target_net.state_dict(), "{}/model_{:04d}_target.pt".format(file_path, iteration))
-
-            # self._values_model.save_weights("{}/model_{:04d}_values.h5".format(file_path, iteration))
-            # self._target_net.save_weights("{}/model_{:04d}_target.h5".format(file_path, iteration))
-
-
-    def load_model(self, file_path='', iteration=None):
-        """ Load existing models based on file_path """
-        """ Saved models put in h5 format.
-            Mapping each layer to its parameter tensor with load_state_dict 
-            ref https://pytorch.org/tutorials/beginner/saving_loading_models.html
-
-        """
-        if iteration is not None:
-            assert isinstance(iteration, int), "iteration should be an integer"
-        else:
-            iteration = 0
-        self._model.load_state_dict(torch.load("{}/model_{:04d}.pt".format(file_path, iteration)))
-        self._full_model.load_state_dict(torch.load("{}/model_{:04d}_full.pt".format(file_path, iteration)))
-        # self._model.load_weights("{}/model_{:04d}.h5".format(file_path, iteration))
-        # self._full_model.load_weights("{}/model_{:04d}_full.h5".format(file_path, iteration))
-        if (self._use_target_net):
-            self._values_model.load_state_dict(torch.load("{}/model_{:04d}_values.pt".format(file_path, iteration)))
-            self._target_net.load_state_dict(torch.load("{}/model_{:04d}_target.pt".format(file_path, iteration)))
-            # self._values_model.load_weights("{}/model_{:04d}_values.h5".format(file_path, iteration))
-            # self._target_net.load_weights("{}/model_{:04d}_target.h5".format(file_path, iteration))
-
-    def update_target_net(self):
-        """Updating the weights of the network
-            ref https://pytorch.org/tutorials/beginner/saving_loading_models.html
-
-        """
-        if (self._use_target_net):
-            model_dict = self._model.state_dict()
-            target_dict = self._target_net.state_dict()
-            for key in model_dict.keys():
-                target_dict[key] = model_dict[key]
-            # self._target_net.set_weights(self._values_model.get_weights())
+        return model
 
+    def _model_outputs(self, model, board):
+        """Action logits are used for acting, overrides parent"""
+        return model.logits(board)
 
     def train_agent(self, batch_size=32, beta=0.001, normalize_rewards=False,
                     num_games=1, reward_clip=False):
@@ -760,8 +1000,9 @@ class AdvantageActorCriticAgent(DeepQLearningAgent):
         """
         # in policy gradient, only one complete episode is used for training
         s, a, r, next_s, done, _ = self._buffer.sample(self._buffer.get_current_size())
-        s_prepared = self._prepare_input(s)
-        next_s_prepared = self._prepare_input(next_s)
+        # copy, the prepared inputs share the same buffer
+        s_prepared = self._board_to_device(s, copy=True)
+        next_s_prepared = self._board_to_device(next_s, copy=True)
         # unlike DQN, the discounted reward is not estimated
         # we have defined custom actor and critic losses functions above
         # use that to train to agent model
@@ -777,35 +1018,45 @@ class AdvantageActorCriticAgent(DeepQLearningAgent):
         if (reward_clip):
             r = np.sign(r)
 
-        # calculate V values
-        if (self._use_target_net):
-            next_s_pred = self._target_net(torch.Tensor(next_s_prepared)).detach().numpy()
-        else:
-            next_s_pred = self._values_model(torch.Tensor(next_s_prepared)).detach().numpy()
-        s_pred = self._values_model(torch.Tensor(s_prepared)).detach().numpy()
-
-        # prepare target
-        future_reward = self._gamma * next_s_pred * (1 - done)
-        # calculate target for actor (uses advantage), similar to Policy Gradient
-        advantage = torch.Tensor(a * (r + future_reward - s_pred))
-
-        # calculate target for critic, simply current reward + future expected reward
-        critic_target = r + future_reward
-
-        model = self._full_model
-        model_out = model(torch.Tensor(s_prepared))
-        policy = F.softmax(model_out[0])
-        log_policy = F.log_softmax(model_out[0])
-        optimizer = torch.optim.RMSprop(model.parameters(), lr=0.0005)
-
-        # calculate loss
-        J = torch.sum(torch.multiply(advantage, log_policy)) / num_games
-        entropy = -torch.sum(torch.multiply(policy, log_policy)) / num_games
-        actor_loss = -J - beta * entropy
-        critic_loss = mean_huber_loss(torch.Tensor(critic_target), model_out[1])
-        loss = actor_loss + critic_loss
-        optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
-        loss = [loss.detach().numpy(), actor_loss.detach().numpy(), critic_loss.detach().numpy()]
+        # the episode buffer has a different size on every call, cudnn
+        # benchmark would autotune every new shape, use its heuristics here,
+        # only benchmark is changed so other cudnn settings are respected
+        benchmark = torch.backends.cudnn.benchmark
+        torch.backends.cudnn.benchmark = False
+        try:
+            # calculate V values, no gradients needed for the targets
+            with torch.inference_mode():
+                if (self._use_target_net):
+                    next_s_pred = self._target_net.values(next_s_prepared).cpu().numpy()
+                else:
+                    next_s_pred = self._model.values(next_s_prepared).cpu().numpy()
+
+            # single forward gives logits for the actor and values for the critic
+            model_out = self._model(s_prepared)
+            s_pred = model_out[1].detach().cpu().numpy()
+
+            # prepare target
+            future_reward = self._gamma * next_s_pred * (1 - done)
+            # calculate target for actor (uses advantage), similar to Policy Gradient
+            advantage = torch.Tensor(a * (r + future_reward - s_pred)).to(self._device)
+
+            # calculate target for critic, simply current reward + future expected reward
+            critic_target = r + future_reward
+
+            policy = F.softmax(model_out[0])
+            log_policy = F.log_softmax(model_out[0])
+
+            # calculate loss
+            J = torch.sum(torch.multiply(advantage, log_policy)) / num_games
+            entropy = -torch.sum(torch.multiply(policy, log_policy)) / num_games
+            actor_loss = -J - beta * entropy
+            critic_loss = mean_huber_loss(torch.Tensor(critic_target).to(self._device), model_out[1])
+            loss = actor_loss + critic_loss
+            self.optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            self.optimizer.step()
+        finally:
+            torch.backends.cudnn.benchmark = benchmark
+        loss = [loss.detach().cpu().numpy(), actor_loss.detach().cpu().numpy(),
+                critic_loss.detach().cpu().numpy()]
         return loss[0] if len(loss) == 1 else loss
\ No newline at end of file
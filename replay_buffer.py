@@ -1,4 +1,6 @@
 import numpy as np
+import pickle
+import torch
 from collections import deque
 
 class ReplayBuffer:
@@ -138,12 +140,13 @@ class ReplayBufferNumpy:
         Buffer for storing the next states, 
         buffer size * board size * board size * frames
     _a : Numpy array
-        Buffer to store the actions, buffer size * 1
+        Buffer to store the actions in one hot encoded format, float32,
+        buffer size * num actions
     _done : Numpy array
-        Buffer to store the binary indicator for termination
+        Buffer to store the binary indicator for termination, float32
         buffer size * 1
     _r : Numpy array
-        Buffer to store the rewards, buffer size * 1
+        Buffer to store the rewards, float32, buffer size * 1
     _legal_moves : Numpy array
         Buffer to store the legal moves in the next state, useful
         when calculating the max of Q values in next state
@@ -156,8 +159,16 @@ class ReplayBufferNumpy:
         to be added to the buffer
     _n_actions : int
         Available actions in the env
+    _pin_memory : bool
+        Whether the buffer arrays live in pinned memory, only when asked for
+        and cuda is available, allows asynchronous copies to the gpu
+    _tensors : dict
+        Torch tensors sharing memory with the numpy buffers above
+    _sample_buffers : dict
+        Reusable tensors into which torch samples are gathered
     """
-    def __init__(self, buffer_size=1000, board_size=6, frames=2, actions=4):
+    def __init__(self, buffer_size=1000, board_size=6, frames=2, actions=4,
+                 pin_memory=False):
         """Initializes the buffer with given size and also sets attributes
 
         Parameters
@@ -170,18 +181,56 @@ class ReplayBufferNumpy:
             Number of frames used in each state in env
         actions : int, optional
             Number of actions available in env
+        pin_memory : bool, optional
+            Allocate the buffer in pinned memory when cuda is available,
+            only useful when the buffer is sampled with sample_torch
         """
         self._buffer_size = buffer_size
         self._current_buffer_size = 0
         self._pos = 0
         self._n_actions = actions
+        self._pin_memory = pin_memory and torch.cuda.is_available()
+
+        self._s = self._zeros((buffer_size, board_size, board_size, frames), torch.uint8)
+        self._next_s = self._zeros((buffer_size, board_size, board_size, frames), torch.uint8)
+        # stored in the dtypes used in training, so sampling needs no casts
+        self._a = self._zeros((buffer_size, self._n_actions), torch.float32)
+        self._done = self._zeros((buffer_size,), torch.float32)
+        self._r = self._zeros((buffer_size,), torch.float32)
+        self._legal_moves = self._zeros((buffer_size, self._n_actions), torch.uint8)
+        self._init_tensors()
+
+    def _zeros(self, shape, dtype):
+        """Zero filled numpy array, allocated directly in pinned
+        memory when the buffer is pinned
+
+        Parameters
+        ----------
+        shape : tuple
+            Shape of the array
+        dtype : torch dtype
+            Data type of the array
+
+        Returns
+        -------
+        array : Numpy array
+            The zero filled array
+        """
+        return torch.zeros(shape, dtype=dtype, pin_memory=self._pin_memory).numpy()
 
-        self._s = np.zeros((buffer_size, board_size, board_size, frames), dtype=np.uint8)
-        self._next_s = self._s.copy()
-        self._a = np.zeros((buffer_size,), dtype=np.uint8)
-        self._done = self._a.copy()
-        self._r = np.zeros((buffer_size,), dtype=np.int16)
-        self._legal_moves = np.zeros((buffer_size, self._n_actions), dtype=np.uint8)
+    def _init_tensors(self):
+        """Create torch tensors sharing memory with the numpy buffers,
+        arrays that are not pinned yet (loaded from disk) are moved to
+        pinned memory and the numpy buffers replaced by views on them
+        """
+        self._tensors = {}
+        for name in ['_s', '_next_s', '_a', '_done', '_r', '_legal_moves']:
+            t = torch.from_numpy(getattr(self, name))
+            if(self._pin_memory and not t.is_pinned()):
+                t = t.pin_memory()
+                setattr(self, name, t.numpy())
+            self._tensors[name] = t
+        self._sample_buffers = {}
 
     def add_to_buffer(self, s, a, r, next_s, done, legal_moves):
         """Add data to the buffer, multiple examples can be added at once
@@ -211,7 +260,9 @@ class ReplayBufferNumpy:
         # % is to wrap over the buffer
         idx = np.arange(self._pos, self._pos+l)%self._buffer_size
         self._s[idx] = s
-        self._a[idx] = a
+        # one hot encoding of actions
+        self._a[idx] = 0
+        self._a[idx, a] = 1
         self._r[idx] = r
         self._next_s[idx] = next_s
         self._done[idx] = done
@@ -268,12 +319,157 @@ class ReplayBufferNumpy:
                                     size=size, replace=replace)
 
         s = self._s[idx]
-        # one hot encoding of actions
-        a = np.zeros((idx.shape[0],self._n_actions))
-        a[np.arange(idx.shape[0]),self._a[idx]] = 1
+        a = self._a[idx]
         r = self._r[idx].reshape((-1, 1))
         next_s = self._next_s[idx]
         done = self._done[idx].reshape(-1, 1)
         legal_moves = self._legal_moves[idx]
 
         return s, a, r, next_s, done, legal_moves
+
+    def save(self, file_path):
+        """Save the buffer arrays and positions to a single uncompressed
+        npz file, the arrays are written directly without pickling
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the npz file to write
+        """
+        np.savez(file_path, s=self._s, next_s=self._next_s, a=self._a,
+                 done=self._done, r=self._r, legal_moves=self._legal_moves,
+                 pos=self._pos, current_buffer_size=self._current_buffer_size)
+
+    def load(self, file_path):
+        """Load the buffer from a npz file written by save, the buffer
+        size is taken from the file
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the npz file to read
+
+        Raises
+        ------
+        FileNotFoundError
+            If the requested file could not be located on the disk
+        ValueError
+            If the board size, frames or actions in the file do not match
+        """
+        with np.load(file_path) as data:
+            self._set_arrays(data['s'], data['next_s'], data['a'], data['done'],
+                             data['r'], data['legal_moves'], int(data['pos']),
+                             int(data['current_buffer_size']))
+
+    def load_pickle(self, file_path):
+        """Load a buffer pickled by older versions, which stored actions
+        as indices and rewards, dones as integers, and convert it
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the pickled buffer
+
+        Raises
+        ------
+        FileNotFoundError
+            If the requested file could not be located on the disk
+        ValueError
+            If the board size, frames or actions in the file do not match
+        """
+        with open(file_path, 'rb') as f:
+            legacy = pickle.load(f)
+        # one hot encoding of actions
+        a = np.zeros((legacy._a.shape[0], self._n_actions), dtype=np.float32)
+        a[np.arange(a.shape[0]), legacy._a] = 1
+        self._set_arrays(legacy._s, legacy._next_s, a,
+                         legacy._done.astype(np.float32), legacy._r.astype(np.float32),
+                         legacy._legal_moves, legacy._pos, legacy._current_buffer_size)
+
+    def _set_arrays(self, s, next_s, a, done, r, legal_moves, pos, current_buffer_size):
+        """Replace the buffer contents after checking that the states and
+        actions have the same shapes as this buffer, the buffer size can differ
+
+        Raises
+        ------
+        ValueError
+            If the board size, frames or actions do not match
+        """
+        if(s.shape[1:] != self._s.shape[1:] or a.shape[1:] != self._a.shape[1:]):
+            raise ValueError("Loaded buffer has states {} and actions {}, expected {} and {}"\
+                             .format(s.shape[1:], a.shape[1:],
+                                     self._s.shape[1:], self._a.shape[1:]))
+        self._s = s
+        self._next_s = next_s
+        self._a = a
+        self._done = done
+        self._r = r
+        self._legal_moves = legal_moves
+        self._buffer_size = s.shape[0]
+        self._pos = pos
+        self._current_buffer_size = current_buffer_size
+        self._init_tensors()
+
+    def _gather(self, name, idx):
+        """Gather rows of a buffer tensor into a reusable (pinned) tensor
+
+        Parameters
+        ----------
+        name : str
+            Name of the buffer to gather from
+        idx : Tensor
+            Indices of the rows to gather
+
+        Returns
+        -------
+        out : Tensor
+            The gathered rows, overwritten by the next call to sample_torch
+        """
+        source = self._tensors[name]
+        out = self._sample_buffers.get(name)
+        if(out is None or out.shape[0] != idx.shape[0]):
+            out = torch.empty((idx.shape[0],) + tuple(source.shape[1:]),
+                              dtype=source.dtype, pin_memory=self._pin_memory)
+            self._sample_buffers[name] = out
+        return torch.index_select(source, 0, idx, out=out)
+
+    def sample_torch(self, size=1000, replace=False):
+        """Sample data from buffer as torch tensors, same layout as sample
+        but without converting through numpy, when the buffer is pinned
+        the returned tensors can be copied to the gpu with non_blocking=True
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of samples to return from the buffer
+        replace : bool, optional
+            Whether sampling is done with replacement
+
+        Returns
+        -------
+        s : Tensor
+            The state matrix for input, size * board size * board size * frame count
+        a : Tensor
+            Array of actions taken in one hot encoded format, size * num actions
+        r : Tensor
+            Array of rewards, size * 1
+        next_s : Tensor
+            The next state matrix for input, size * board size * board size * frame count
+        done : Tensor
+            Binary indicators for game termination, size * 1
+        legal_moves : Tensor
+            Binary indicators for legal moves in the next state, size * num actions
+        """
+        size = min(size, self._current_buffer_size)
+        idx = torch.from_numpy(np.random.choice(np.arange(self._current_buffer_size),
+                                                size=size, replace=replace))
+
+        s = self._gather('_s', idx)
+        # one hot encoding of actions
+        a = self._gather('_a', idx)
+        r = self._gather('_r', idx).reshape((-1, 1))
+        next_s = self._gather('_next_s', idx)
+        done = self._gather('_done', idx).reshape(-1, 1)
+        legal_moves = self._gather('_legal_moves', idx)
+
+        return s, a, r, next_s, done, legal_moves
@@ -205,8 +205,10 @@ def play_game2(env, agent, n_actions, n_games=100, epsilon=0.01, record=True,
         if(np.random.random() <= epsilon):
             # use epsilon greedy policy to get next action
             # action = np.random.choice(n_actions, n_games)
-            action = np.argmax(np.where(legal_moves>0, 
-                        np.random.random((n_games, n_actions)),-1), axis=1)
+            # mask illegal moves in place instead of creating another array
+            action = np.random.random((n_games, n_actions))
+            action[legal_moves <= 0] = -1
+            action = np.argmax(action, axis=1)
         else:
             # else select action using agent outputs
             if(sample_actions):